@@ -1,9 +1,13 @@
 import os
-import math
 import argparse
+import itertools
+import numpy as np
 import requests
 import time
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 # Default tile URLs
@@ -16,24 +20,55 @@ TILE_URLS = {
 
 HEADERS = {"User-Agent": "Mozilla/5.0 (Raspberry Pi; Offline Tile Downloader)"}
 
+# Keep these low - tile servers rate limit aggressive clients
+MAX_WORKERS = 4
+REQUESTS_PER_SECOND = 5.0
+
+class TokenBucket:
+    # Shared by all download workers; only real HTTP requests take a token,
+    # so tiles already on disk are skipped at full speed
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            # A negative balance is a reservation; later callers wait behind it
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
 def deg2num(lat_deg, lon_deg, zoom):
-    lat_rad = math.radians(lat_deg)
-    n = 2 ** zoom
-    x = int((lon_deg + 180.0) / 360.0 * n)
-    y = int((1 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2 * n)
+    # Accepts scalars or arrays (e.g. every zoom level at once); truncates like int()
+    lat_rad = np.radians(lat_deg)
+    n = 2.0 ** np.asarray(zoom)
+    x = ((np.asarray(lon_deg) + 180.0) / 360.0 * n).astype(np.int64)
+    y = ((1 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2 * n).astype(np.int64)
     return x, y
 
-def download_tile(z, x, y, output_dir, tile_url):
-    tile_dir = os.path.join(output_dir, str(z), str(x))
-    os.makedirs(tile_dir, exist_ok=True)
-    tile_path = os.path.join(tile_dir, f"{y}.png")
+def make_session():
+    # One keep-alive session shared by all workers avoids a TLS handshake per tile
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS * 2, pool_maxsize=MAX_WORKERS * 2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    if os.path.exists(tile_path):
-        return tile_path  # already downloaded
+def download_tile(session, bucket, z, x, y, output_dir, tile_url):
+    tile_path = os.path.join(output_dir, str(z), str(x), f"{y}.png")
 
     for attempt in range(5):  # more retries
         try:
-            r = requests.get(tile_url, headers=HEADERS, timeout=15)
+            bucket.acquire()
+            r = session.get(tile_url, timeout=15)
             if r.status_code == 200:
                 with open(tile_path, "wb") as f:
                     f.write(r.content)
@@ -83,24 +118,50 @@ def download_tiles(min_lat, min_lon, max_lat, max_lon, zoom_levels, tile_type, o
     tile_url_template = TILE_URLS[tile_type]
     conn = init_mbtiles(mbtiles, name=f"{tile_type.upper()} Tiles") if mbtiles else None
 
-    for z in zoom_levels:
+    # Repeated --zoom values would queue the same tiles twice and write them concurrently
+    zooms = np.unique(zoom_levels)
+    x1, y1 = deg2num(min_lat, min_lon, zooms)
+    x2, y2 = deg2num(max_lat, max_lon, zooms)
+    x_starts, x_ends = np.minimum(x1, x2), np.maximum(x1, x2)
+    y_starts, y_ends = np.minimum(y1, y2), np.maximum(y1, y2)
+
+    tasks = []
+    for z, x_start, x_end, y_start, y_end in zip(zooms.tolist(), x_starts.tolist(), x_ends.tolist(),
+                                                 y_starts.tolist(), y_ends.tolist()):
         print(f"\n📡 Zoom level {z}")
-        x1, y1 = deg2num(min_lat, min_lon, z)
-        x2, y2 = deg2num(max_lat, max_lon, z)
-        x_start, x_end = sorted([x1, x2])
-        y_start, y_end = sorted([y1, y2])
         print(f"Zoom {z}: X {x_start}-{x_end}, Y {y_start}-{y_end}")
 
-        total = (x_end - x_start + 1) * (y_end - y_start + 1)
-        with tqdm(total=total, desc=f"Downloading Z{z}") as pbar:
-            for x in range(x_start, x_end + 1):
-                for y in range(y_start, y_end + 1):
-                    tile_url = tile_url_template.format(z=z, x=x, y=y)
-                    tile_path = download_tile(z, x, y, output_dir, tile_url)
-                    if conn:
-                        insert_tile(conn, z, x, y, tile_path)
-                    pbar.update(1)
-                    time.sleep(0.05)
+        xs, ys = np.meshgrid(np.arange(x_start, x_end + 1), np.arange(y_start, y_end + 1), indexing="ij")
+        # tolist() gives plain ints, which sqlite3 and str.format expect
+        tasks.extend(zip(itertools.repeat(z), xs.ravel().tolist(), ys.ravel().tolist()))
+
+    # Create each z/x directory once and list the tiles already on disk,
+    # rather than a makedirs + exists pair per tile
+    existing = set()
+    for z, x in {(z, x) for z, x, _ in tasks}:
+        tile_dir = os.path.join(output_dir, str(z), str(x))
+        os.makedirs(tile_dir, exist_ok=True)
+        with os.scandir(tile_dir) as entries:
+            existing.update((z, x, int(e.name[:-4])) for e in entries
+                            if e.name.endswith(".png") and e.name[:-4].isdigit())
+
+    session = make_session()
+    bucket = TokenBucket(REQUESTS_PER_SECOND)
+
+    def fetch_one(task):
+        z, x, y = task
+        if task in existing:
+            return z, x, y, os.path.join(output_dir, str(z), str(x), f"{y}.png")  # already downloaded
+
+        tile_url = tile_url_template.format(z=z, x=x, y=y)
+        tile_path = download_tile(session, bucket, z, x, y, output_dir, tile_url)
+        return z, x, y, tile_path
+
+    # Downloads run in the pool; MBTiles inserts stay on this thread (sqlite connection)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        for z, x, y, tile_path in tqdm(ex.map(fetch_one, tasks), total=len(tasks), desc="Downloading"):
+            if conn:
+                insert_tile(conn, z, x, y, tile_path)
 
     if conn:
         conn.commit()
@@ -0,0 +1,273 @@
+from gps3 import gps3
+from gps_shared import TRACK_COLUMNS, TRACK_DIR, GpsSnapshot, open_shm, write_snapshot
+import atexit
+import csv
+import gzip
+import os
+import select
+import signal
+import time
+import datetime
+
+# Runs as its own process (see gps_poller.service) so GPS parsing and logging never
+# compete with the web server for the GIL; the latest fix is published through
+# shared memory for gps_server.py to read
+
+# Logging presets, set from the environment (or gps_poller.service) instead of
+# keeping copies of this script per variant, e.g. GPS_LOG_FIELDS=lat,lon for a
+# position-only track or GPS_RAW_LOG=0 to skip the raw feed
+LOG_FIELDS = [field.strip() for field in os.environ.get("GPS_LOG_FIELDS", ",".join(TRACK_COLUMNS)).split(",") if field.strip()]
+LOG_INTERVAL = float(os.environ.get("GPS_LOG_INTERVAL", 5))  # seconds between CSV rows
+RAW_LOG_ENABLED = os.environ.get("GPS_RAW_LOG", "1") != "0"
+
+unknown_fields = [field for field in LOG_FIELDS if field not in TRACK_COLUMNS]
+if unknown_fields or not LOG_FIELDS:
+    raise SystemExit(f"[ERROR] GPS_LOG_FIELDS must be a comma-separated subset of {','.join(TRACK_COLUMNS)}; "
+                     f"got {os.environ.get('GPS_LOG_FIELDS')!r}")
+
+last_logged_mono = float('-inf')  # time.monotonic() of the last CSV row
+
+# The track is partitioned by hour so the file being appended to stays small and
+# finished hours are never touched again (they can be compressed or copied off)
+TRACK_TEMPLATE = os.path.join(TRACK_DIR, "track_%Y%m%d%H.csv")
+CSV_HEADER = ["timestamp"] + [TRACK_COLUMNS[field] for field in LOG_FIELDS]
+
+# CSV rows are buffered and written in batches instead of re-opening the file per row
+CSV_BATCH_SIZE = 10
+CSV_FLUSH_INTERVAL = 30  # seconds
+
+os.makedirs(TRACK_DIR, exist_ok=True)
+csv_handle = None  # opened on the first row of each hour
+csv_hour = None
+pending_rows = []
+last_flush_mono = time.monotonic()
+
+# The track CSV has exactly one writer, the polling loop, so no lock is taken.
+# The atexit call swaps the batch out first so it never iterates a list being appended to.
+def flush_pending_rows():
+    global pending_rows, last_flush_mono
+
+    if csv_handle is None:
+        return
+    rows, pending_rows = pending_rows, []
+    if rows:
+        csv_handle.write("".join(rows))
+    csv_handle.flush()
+    last_flush_mono = time.monotonic()
+
+def read_csv_header(path):
+    with open(path, newline="") as f:
+        return next(csv.reader([f.readline()]), [])
+
+def track_csv_path(now):
+    # Continue the hour's latest file, unless it was written with other
+    # GPS_LOG_FIELDS; then start track_YYYYMMDDHH_<n>.csv so every file has
+    # exactly one header that matches its rows
+    base = now.strftime(TRACK_TEMPLATE)[:-len(".csv")]
+    n = 0
+    while os.path.exists(f"{base}_{n + 1}.csv"):
+        n += 1
+    path = f"{base}_{n}.csv" if n else f"{base}.csv"
+    if os.path.exists(path) and os.path.getsize(path) and read_csv_header(path) != CSV_HEADER:
+        path = f"{base}_{n + 1}.csv"
+    return path
+
+# Checked from the polling loop on every pass (data or select timeout), so queued
+# rows still reach the file while there is no fix and no new rows are logged
+def flush_pending_rows_if_due():
+    if pending_rows and (len(pending_rows) >= CSV_BATCH_SIZE or time.monotonic() - last_flush_mono > CSV_FLUSH_INTERVAL):
+        flush_pending_rows()
+
+def rotate_track_csv(now):
+    global csv_handle, csv_hour
+
+    # Rows already queued belong to the previous hour
+    flush_pending_rows()
+    if csv_handle is not None:
+        csv_handle.close()
+
+    path = track_csv_path(now)
+    new_file = not os.path.exists(path) or not os.path.getsize(path)
+    csv_handle = open(path, mode="a", newline="", buffering=1 << 16)
+    if new_file:
+        csv.writer(csv_handle).writerow(CSV_HEADER)
+    csv_hour = now.replace(minute=0, second=0, microsecond=0)
+
+atexit.register(flush_pending_rows)
+
+def csv_value(value):
+    return '' if value is None else str(value)
+
+# While stationary the same fix is not re-logged every LOG_INTERVAL; a checkpoint
+# row is still written every CHECKPOINT_INTERVAL to show we are still there
+# Tolerances sit around the jitter of a stationary consumer GPS fix (a couple of
+# metres, a few tenths of a m/s); anything tighter would almost never match
+POSITION_TOLERANCE = 2e-5  # degrees, about 2 m of latitude
+SPEED_TOLERANCE = 0.2  # m/s
+CHECKPOINT_INTERVAL = 300  # seconds
+last_row_fix = None  # (lat, lon, speed) of the last CSV row
+last_row_mono = float('-inf')
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def same_fix(fix, prev):
+    # Values that are not numbers (None, gps3's "n/a") are only equal to themselves
+    if prev is None:
+        return False
+    for value, prev_value, tolerance in zip(fix, prev, (POSITION_TOLERANCE, POSITION_TOLERANCE, SPEED_TOLERANCE)):
+        if is_number(value) and is_number(prev_value):
+            if abs(value - prev_value) >= tolerance:
+                return False
+        elif value != prev_value:
+            return False
+    return True
+
+# Raw GPSD feed goes to gzip files (level 1 is cheap on the Pi CPU and cuts what
+# reaches the SD card). Every flush ends a deflate block, so it is done on a timer
+# rather than per line; the day is checked at the same point. Each process start
+# and each new day gets its own file: appending to one left truncated by an
+# unclean stop would make the rest of it unreadable.
+RAW_LOG_TEMPLATE = "raw_gps_log_%Y%m%d_%H%M%S.json.gz"
+RAW_LOG_FLUSH_INTERVAL = 10  # seconds
+
+def open_raw_log():
+    global raw_log, raw_log_day
+
+    now = datetime.datetime.now()
+    raw_log_day = now.date()
+    raw_log = gzip.open(now.strftime(RAW_LOG_TEMPLATE), "xb", compresslevel=1)
+
+def close_raw_log():
+    raw_log.close()
+
+raw_log = None
+if RAW_LOG_ENABLED:
+    open_raw_log()
+    atexit.register(close_raw_log)
+raw_log_last_flush = time.monotonic()
+
+shm = open_shm()
+
+def tpv_value(tpv, key):
+    # gps3 fills fields missing from a report with "n/a"
+    value = tpv.get(key)
+    return value if is_number(value) else None
+
+def handle_sentence(new_data, data_stream):
+    global last_logged_mono, last_row_fix, last_row_mono, raw_log_last_flush
+
+    #print(f"[RAW] {new_data}")
+    if raw_log is not None:
+        raw_log.write(new_data.encode())
+        raw_log.write(b"\n")
+        if time.monotonic() - raw_log_last_flush > RAW_LOG_FLUSH_INTERVAL:
+            if datetime.date.today() != raw_log_day:
+                raw_log.close()
+                open_raw_log()
+            else:
+                raw_log.flush()
+            raw_log_last_flush = time.monotonic()
+
+    # Only TPV reports are used below; skip JSON-decoding SKY, DEVICE, etc.
+    # gpsd emits compact JSON, so a substring test is enough
+    if '"class":"TPV"' not in new_data:
+        return
+
+    try:
+        data_stream.unpack(new_data)
+    except Exception as e:
+        #print(f"[WARN] Failed to unpack GPSD data: {e}")
+        return
+
+    tpv = data_stream.TPV
+    lat = tpv.get("lat", "n/a")
+    lon = tpv.get("lon", "n/a")
+    #print(f"[GPS] lat: {lat}, lon: {lon}")
+
+    if lat != "n/a" and lon != "n/a":
+        # Publish the new fix to the web server
+        snap = GpsSnapshot(
+            lat=lat,
+            lon=lon,
+            speed=tpv_value(tpv, "speed"),  # m/s
+            track=tpv_value(tpv, "track"),  # degrees
+            epx=tpv_value(tpv, "epx"),
+            epy=tpv_value(tpv, "epy"),
+            epv=tpv_value(tpv, "epv"),
+            eps=tpv_value(tpv, "eps"),
+            ts=time.time()
+        )
+        write_snapshot(shm.buf, snap)
+
+        # Throttle on the monotonic clock so wall clock jumps (NTP, GPS time sync)
+        # can't stall or burst the log; wall clock is only used for the row itself
+        now = time.monotonic()
+        if now - last_logged_mono > LOG_INTERVAL:
+            last_logged_mono = now
+
+            fix = (lat, lon, snap.speed)
+            if not same_fix(fix, last_row_fix) or now - last_row_mono >= CHECKPOINT_INTERVAL:
+                last_row_fix = fix
+                last_row_mono = now
+
+                wall_now = datetime.datetime.now()
+                if wall_now.replace(minute=0, second=0, microsecond=0) != csv_hour:
+                    rotate_track_csv(wall_now)
+
+                timestamp = wall_now.isoformat(sep=' ', timespec='seconds')
+                # All fields are numbers or a timestamp, so no quoting is needed and the
+                # row is joined directly; \r\n matches what csv.writer wrote before
+                pending_rows.append(
+                    ",".join([timestamp] + [csv_value(getattr(snap, field)) for field in LOG_FIELDS]) + "\r\n"
+                )
+
+# Set from the SIGTERM/SIGINT handler and checked by poll_gps() between reads, so the
+# loop returns normally and the atexit flushes never see a half-swapped batch
+stop_requested = False
+
+def request_stop(signum, frame):
+    global stop_requested
+    stop_requested = True
+
+def poll_gps():
+    gps_socket = gps3.GPSDSocket()
+    data_stream = gps3.DataStream()
+    gps_socket.connect()
+    gps_socket.watch()
+
+    print("[INFO] GPS poller started.")
+
+    # Block on the GPSD socket instead of spinning on gps3's zero-timeout iterator
+    sock = gps_socket.streamSock
+    buffer = bytearray()
+
+    while not stop_requested:
+        readable, _, _ = select.select([sock], [], [], 1.0)
+        if stop_requested:
+            break
+        flush_pending_rows_if_due()
+        if not readable:
+            continue
+
+        chunk = sock.recv(4096)
+        if not chunk:
+            print("[WARN] GPSD closed the connection.")
+            break
+
+        buffer += chunk
+        *lines, rest = buffer.split(b"\n")
+        buffer = bytearray(rest)
+
+        for line in lines:
+            new_data = line.decode("utf-8", errors="replace").strip()
+            if new_data:
+                handle_sentence(new_data, data_stream)
+        flush_pending_rows_if_due()
+
+if __name__ == '__main__':
+    # systemd stops us with SIGTERM; finish the current pass and exit normally
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    poll_gps()
+    print("[INFO] GPS poller stopped.")
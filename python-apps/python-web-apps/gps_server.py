@@ -1,98 +1,88 @@
-from flask import Flask, jsonify, send_from_directory, render_template
-from gps3 import gps3
+from flask import Flask, Response, abort, request, send_from_directory, render_template
+from gps_shared import EMPTY_SNAPSHOT, TRACK_DIR, TRACK_HEADER, open_shm, read_snapshot
 import csv
+import orjson
 import os
-import time
-import datetime
-import threading
+from email.utils import formatdate
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 
-csv_file = "track.csv"
-lock = threading.Lock()
-last_logged_time = 0
-log_filename = datetime.datetime.now().strftime("raw_gps_log_%Y%m%d_%H%M%S.json")
-
-# Shared state
-latest_data = {
-    'lat': None,
-    'lon': None,
-    'speed': None,
-    'track': None,
-    'epx': None,
-    'epy': None,
-    'epv': None,
-    'eps': None
-}
-
-def gps_polling_thread():
-    global last_logged_time
-
-    gps_socket = gps3.GPSDSocket()
-    data_stream = gps3.DataStream()
-    gps_socket.connect()
-    gps_socket.watch()
-
-    print("[INFO] GPS polling thread started.")
-
-    for new_data in gps_socket:
-        if not new_data:
-            continue
-
-        #print(f"[RAW] {new_data}")
-        with open(log_filename, "a") as f:
-            f.write(new_data + "\n")
-
-        try:
-            data_stream.unpack(new_data)
-        except Exception as e:
-            #print(f"[WARN] Failed to unpack GPSD data: {e}")
-            continue
-
-        tpv = data_stream.TPV
-        lat = tpv.get("lat", "n/a")
-        lon = tpv.get("lon", "n/a")
-        #print(f"[GPS] lat: {lat}, lon: {lon}")
-
-        if lat != "n/a" and lon != "n/a":
-            # Update shared latest_data
-            latest_data.update({
-                'lat': lat,
-                'lon': lon,
-                'speed': tpv.get("speed", None),  # m/s
-                'track': tpv.get("track", None),  # degrees
-                'epx': tpv.get("epx", None),
-                'epy': tpv.get("epy", None),
-                'epv': tpv.get("epv", None),
-                'eps': tpv.get("eps", None)
-            })
-
-            now = time.time()
-            if now - last_logged_time > 5:
-                with lock:
-                    with open(csv_file, mode="a", newline="") as f:
-                        writer = csv.writer(f)
-                        writer.writerow([
-                            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
-                            lat,
-                            lon,
-                            latest_data['speed'],
-                            latest_data['track'],
-                            latest_data['epx'],
-                            latest_data['epy'],
-                            latest_data['epv'],
-                            latest_data['eps']
-                        ])
-                last_logged_time = now
+# Single-file track written before the hourly partitions in TRACK_DIR
+legacy_csv_file = "track.csv"
+
+# The latest fix is published by gps_poller.py (a separate process) through shared
+# memory. The JSON payload and its validators are rebuilt only when the sequence
+# number changes, and swapped in as one tuple so readers never mix generations.
+shm = open_shm()
+gps_payload = (0, orjson.dumps(EMPTY_SNAPSHOT._asdict()), None, None)  # (seq, json, etag, last_modified)
+
+def current_gps_payload():
+    global gps_payload
+
+    seq, snap = read_snapshot(shm.buf)
+    if seq != gps_payload[0]:
+        if snap.ts is not None:
+            # The sequence number identifies the fix; the millisecond fix time keeps
+            # the tag unique if the shared memory (and its counter) is recreated
+            etag = f'"{seq:x}-{int(snap.ts * 1000):x}"'
+            last_modified = formatdate(timeval=snap.ts, usegmt=True)
+        else:
+            etag = last_modified = None
+        gps_payload = (seq, orjson.dumps(snap._asdict()), etag, last_modified)
+    return gps_payload
 
 @app.route('/')
 #def serve_index():
 def index():
     return render_template('index.html')
 
+def partition_order(name):
+    # track_YYYYMMDDHH.csv, then track_YYYYMMDDHH_<n>.csv for restarts with other
+    # GPS_LOG_FIELDS in the same hour; plain string order would misplace "_<n>"
+    hour, _, n = name[len("track_"):-len(".csv")].partition("_")
+    return hour, int(n) if n.isdigit() else 0
+
+def track_partitions():
+    track_dir = os.path.join(app.root_path, TRACK_DIR)
+    if not os.path.isdir(track_dir):
+        return []
+    names = [name for name in os.listdir(track_dir) if name.startswith("track_") and name.endswith(".csv")]
+    return sorted(names, key=partition_order)
+
+@app.route('/tracks')
+def list_tracks():
+    return Response(orjson.dumps(track_partitions()), mimetype='application/json')
+
+@app.route('/tracks/<name>')
+def download_track_partition(name):
+    return send_from_directory(TRACK_DIR, name, as_attachment=True)
+
+# Whole track as one CSV with the full TRACK_HEADER layout. Partitions already in
+# that layout are streamed as-is; ones logged with fewer GPS_LOG_FIELDS are
+# remapped column by column, leaving the missing columns empty.
 @app.route('/track.csv')
 def download_track():
-    return send_from_directory('.', csv_file, as_attachment=True)
+    paths = [os.path.join(app.root_path, TRACK_DIR, name) for name in track_partitions()]
+    legacy_path = os.path.join(app.root_path, legacy_csv_file)
+    if os.path.exists(legacy_path):
+        paths.insert(0, legacy_path)
+
+    def generate():
+        yield ",".join(TRACK_HEADER) + "\r\n"
+        for path in paths:
+            with open(path, newline="") as f:
+                header = next(csv.reader([f.readline()]), [])
+                if header == TRACK_HEADER:
+                    while chunk := f.read(1 << 16):
+                        yield chunk
+                    continue
+
+                columns = [header.index(name) if name in header else None for name in TRACK_HEADER]
+                for row in csv.reader(f):
+                    yield ",".join(row[i] if i is not None and i < len(row) else "" for i in columns) + "\r\n"
+
+    return Response(generate(), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=track.csv'})
 
 @app.route('/track')
 def serve_track_viewer():
@@ -100,7 +90,17 @@ def serve_track_viewer():
 
 @app.route('/gps')
 def get_gps():
-    return jsonify(latest_data)
+    _, payload, etag, last_modified = current_gps_payload()
+    if etag is None:
+        return Response(payload, mimetype='application/json')
+
+    # Revalidation uses the ETag only: Last-Modified has one second resolution and
+    # GPS fixes can arrive several times a second, so it is sent as a hint only.
+    # no-cache makes the browser revalidate every poll instead of guessing freshness
+    headers = {'ETag': etag, 'Last-Modified': last_modified, 'Cache-Control': 'no-cache'}
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers=headers)
+    return Response(payload, mimetype='application/json', headers=headers)
 
 #@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
 #def serve_tile(z, x, y):
@@ -108,31 +108,57 @@ def get_gps():
 #    print(f"[TILE REQUEST] /tiles/{tile_path}")
 #    return send_from_directory("tiles", tile_path)
 
+# When running behind nginx, set TILE_ACCEL_REDIRECT to an internal location so
+# tile bodies are sent by nginx (sendfile) instead of being read through Python:
+#
+#   location /internal_tiles/ {
+#       internal;
+#       alias /path/to/python-web-apps/;
+#   }
+TILE_ACCEL_REDIRECT = os.environ.get("TILE_ACCEL_REDIRECT")  # e.g. "/internal_tiles"
+
+# Downloaded tiles never change, so let the browser keep them
+TILE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def send_tile(folder, z, x, y):
+    tile_path = os.path.join(app.root_path, folder, str(z), str(x), f"{y}.png")
+    try:
+        st = os.stat(tile_path)
+    except FileNotFoundError:
+        abort(404)
+
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers={'ETag': etag, 'Cache-Control': TILE_CACHE_CONTROL})
+
+    if TILE_ACCEL_REDIRECT:
+        resp = Response(headers={
+            'X-Accel-Redirect': f"{TILE_ACCEL_REDIRECT}/{folder}/{z}/{x}/{y}.png",
+            'Content-Type': 'image/png'
+        })
+    else:
+        resp = send_from_directory(folder, f"{z}/{x}/{y}.png")
+    resp.headers['ETag'] = etag
+    resp.headers['Cache-Control'] = TILE_CACHE_CONTROL
+    return resp
+
 # Serve OSM tiles
 @app.route('/tiles_osm/<int:z>/<int:x>/<int:y>.png')
 def tiles_osm(z, x, y):
-    return send_from_directory("tiles_osm", f"{z}/{x}/{y}.png")
+    return send_tile("tiles_osm", z, x, y)
 
 # Serve Satellite tiles
 @app.route('/tiles_satellite/<int:z>/<int:x>/<int:y>.png')
 def tiles_satellite(z, x, y):
-    return send_from_directory("tiles_sat", f"{z}/{x}/{y}.png")
+    return send_tile("tiles_sat", z, x, y)
 
 
 if __name__ == '__main__':
-    # Create CSV with new headers if needed
-    if not os.path.exists(csv_file):
-        with open(csv_file, mode="w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                "timestamp", "latitude", "longitude",
-                "speed (m/s)", "heading (°)",
-                "epx", "epy", "epv", "eps"
-            ])
-
-    thread = threading.Thread(target=gps_polling_thread, daemon=True)
-    thread.start()
+    print("[INFO] Reading GPS fixes from gps_poller.py via shared memory")
+
+    # Serve with waitress instead of the Werkzeug development server
+    from waitress import serve
 
     print("[INFO] Flask server running at http://0.0.0.0:5000")
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+    serve(app, host='0.0.0.0', port=5000, threads=8, channel_timeout=30)
 
@@ -0,0 +1,79 @@
+import math
+import os
+import struct
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+# Latest fix shared between gps_poller.py (single writer) and gps_server.py (readers)
+SHM_NAME = "gps_tracker_snapshot"
+SHM_SIZE = 128
+SHM_ATTACH_TIMEOUT = 2  # seconds to wait for the creator to size the segment
+
+# gps_poller.py writes track CSVs here, one file per hour (track_YYYYMMDDHH.csv)
+TRACK_DIR = "tracks"
+
+# CSV column for each loggable snapshot field. A full track row has all of them in
+# this order; GPS_LOG_FIELDS may select fewer, and the file header says which.
+TRACK_COLUMNS = {
+    "lat": "latitude", "lon": "longitude",
+    "speed": "speed (m/s)", "track": "heading (°)",
+    "epx": "epx", "epy": "epy", "epv": "epv", "eps": "eps"
+}
+TRACK_HEADER = ["timestamp"] + list(TRACK_COLUMNS.values())
+
+GpsSnapshot = namedtuple('GpsSnapshot', 'lat lon speed track epx epy epv eps ts')
+EMPTY_SNAPSHOT = GpsSnapshot(*[None] * len(GpsSnapshot._fields))
+
+# Layout: sequence counter, then the nine snapshot fields as doubles (None -> NaN).
+# The counter is odd while the writer is mid-update (seqlock); 0 means no fix yet.
+SEQ_STRUCT = struct.Struct('=Q')
+SNAPSHOT_STRUCT = struct.Struct('=Q9d')
+FIELDS_STRUCT = struct.Struct('=9d')
+
+def open_shm():
+    # Whichever process starts first creates the segment. It is never unlinked,
+    # so the poller and the web server can be restarted independently.
+    try:
+        shm = shared_memory.SharedMemory(name=SHM_NAME, create=True, size=SHM_SIZE)
+        # Created 0600; the poller (root) and gps_server.py (pi) both need it
+        os.fchmod(shm._fd, 0o666)
+    except FileExistsError:
+        shm = attach_shm()
+    # Otherwise the resource tracker unlinks the segment when this process exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def attach_shm():
+    # The creator may not have sized the segment yet; mmap of an empty file fails
+    deadline = time.monotonic() + SHM_ATTACH_TIMEOUT
+    while True:
+        try:
+            shm = shared_memory.SharedMemory(name=SHM_NAME)
+        except ValueError:
+            if time.monotonic() > deadline:
+                raise
+        else:
+            if shm.size >= SHM_SIZE:
+                return shm
+            shm.close()
+            if time.monotonic() > deadline:
+                raise ValueError(f"shared memory {SHM_NAME} is smaller than {SHM_SIZE} bytes")
+        time.sleep(0.05)
+
+def write_snapshot(buf, snap):
+    seq = SEQ_STRUCT.unpack_from(buf)[0] | 1
+    SEQ_STRUCT.pack_into(buf, 0, seq)
+    FIELDS_STRUCT.pack_into(buf, SEQ_STRUCT.size, *(math.nan if v is None else v for v in snap))
+    SEQ_STRUCT.pack_into(buf, 0, seq + 1)
+
+def read_snapshot(buf, retries=100):
+    # Returns (seq, snapshot). Retries while a write is in progress; if the writer
+    # died mid-update, gives up and returns what is there.
+    for _ in range(retries):
+        seq, *fields = SNAPSHOT_STRUCT.unpack_from(buf)
+        if not seq & 1 and SEQ_STRUCT.unpack_from(buf)[0] == seq:
+            break
+    if seq == 0:
+        return seq, EMPTY_SNAPSHOT
+    return seq, GpsSnapshot(*(None if math.isnan(v) else v for v in fields))